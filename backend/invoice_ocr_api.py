@@ -1,20 +1,35 @@
 import uvicorn
 import os
+import asyncio
 import re
 import uuid
 import csv
+import hashlib
+import threading
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
 from io import StringIO, BytesIO
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Iterator
 
 # Third-party libraries (Requires: fastapi, uvicorn, pydantic, python-multipart, Pillow, opencv-python, pytesseract)
 from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import JSONResponse, Response
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 
 # Global mock database for storing parsed invoices
 # In production, this would be replaced by Firestore or PostgreSQL
-MOCK_DATABASE: Dict[str, Dict[str, Any]] = {}
+# Stores the ParsedInvoice instances themselves, so downloads need no re-validation
+# NOTE: this (like OCR_CACHE) lives in each process, so it only works with a single API worker;
+# with several workers a download can reach a worker that never saw the upload (404)
+MOCK_DATABASE: Dict[str, "ParsedInvoice"] = {}
+
+# Keep Tesseract single-threaded per process; throughput comes from running more workers,
+# not from OpenMP threads competing for the same cores. Must be set before libtesseract loads.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
 
 # --- OCR DEPENDENCY CHECK AND CONFIGURATION ---
 try:
@@ -36,25 +51,52 @@ except ImportError:
     # If imports fail, this print statement will alert the user when the API runs.
     print("WARNING: OCR dependencies (pytesseract, opencv-python, numpy) not found. Using mock OCR.")
 
+# --- OPTIONAL IN-PROCESS TESSERACT (tesserocr) ---
+# tesserocr talks to libtesseract directly, so the model is loaded once per worker thread
+# instead of spawning a tesseract subprocess (and re-reading eng.traineddata) on every request.
+# pytesseract remains the fallback when tesserocr is not installed.
+try:
+    from tesserocr import PyTessBaseAPI, PSM, OEM
+    HAS_TESSEROCR = HAS_OCR_DEPS
+except ImportError:
+    HAS_TESSEROCR = False
+
+# PyTessBaseAPI is not thread-safe, so each worker thread gets its own instance
+_TESS_LOCAL = threading.local()
+
+def _get_tess_api() -> "PyTessBaseAPI":
+    """Returns the calling thread's PyTessBaseAPI, creating it on first use."""
+    api = getattr(_TESS_LOCAL, "api", None)
+    if api is None:
+        api = PyTessBaseAPI(lang='eng', psm=PSM.AUTO, oem=OEM.LSTM_ONLY)
+        _TESS_LOCAL.api = api
+    return api
+
 
 # Regex patterns for general parsing (flexible schema)
+# Patterns run against the upper-cased ASCII form of the OCR text (see _to_search_text),
+# so literals must be written in upper case and non-ASCII characters show up as '?'.
+# As bytes patterns, \w, \d and \s are ASCII-only: a value containing non-ASCII characters
+# is not captured or is cut short (e.g. "Invoice: ÄB12" -> no match, "AB€12" -> "AB").
 INVOICE_CONFIG = {
     # General Header Fields
-    "invoice_number": r"(?:Invoice No\.|Invoice|Bill)\s*[:#-]\s*(\w+)",
-    "date": r"(?:Invoice Date|DATED|Date)\s*[:#-]\s*(\d{2}[-/]\d{2}[-/]\d{2,4})",
+    "invoice_number": r"(?:INVOICE NO\.|INVOICE|BILL)\s*[:#-]\s*(\w+)",
+    "date": r"(?:INVOICE DATE|DATED|DATE)\s*[:#-]\s*(\d{2}[-/]\d{2}[-/]\d{2,4})",
     
     # FIX: Targeted extraction for Total Amount and Tax Amount, looking near keywords
-    "total_amount": r"(?:PAYABLE AMOUNT|GRAND TOTAL|TOTAL|AMOUNT DUE|BALANCE)\s*(?:[A-Z]{3}|\$|€|£|Rs\.\s*)?\s*([\d,\.]+)",
-    "tax_amount": r"(?:TAX|GST|VAT|SGST|CGST)\s*RATE\s*@\s*\d+%?\s*Rs\.\s*([\d,\.]+)",
+    # ('\?' stands for the non-ASCII currency signs € and £)
+    "total_amount": r"(?:PAYABLE AMOUNT|GRAND TOTAL|TOTAL|AMOUNT DUE|BALANCE)\s*(?:[A-Z]{3}|\$|\?|RS\.\s*)?\s*([\d,\.]+)",
+    "tax_amount": r"(?:TAX|GST|VAT|SGST|CGST)\s*RATE\s*@\s*\d+%?\s*RS\.\s*([\d,\.]+)",
     
     # FIX: Use a unique header keyword like the company name to reliably find the vendor, skipping the junk OCR output
     "vendor_name": r"(S\.K\.P\.S DIGITAL)", 
-    "gst_number": r"(?:GSTIN|VAT ID|Tax ID)\s*[:#]\s*(\w+)",
+    "gst_number": r"(?:GSTIN|VAT ID|TAX ID)\s*[:#]\s*(\w+)",
     
     # FIX: Line Item Structure - Adjusted to capture only Description, Rate, and Total, as QTY was dropped by OCR
-    # Finds: (Description group) (Rate group) (Total group)
-    # The description group now includes the item name, but we assume the numbers are Rate and Total.
-    "line_item_pattern": r"ITEM NAME \d\s+Rs\.\s*([\d,\.]+)\s+Rs\.\s*([\d,\.]+)"
+    # Finds: (Item number group) (Rate group) (Total group)
+    # The item number builds the description; we assume the numbers are Rate and Total.
+    # Separators are restricted to spaces/tabs so a match never spans two OCR lines.
+    "line_item_pattern": r"ITEM NAME (\d)[ \t]+RS\.[ \t]*([\d,\.]+)[ \t]+RS\.[ \t]*([\d,\.]+)"
 }
 
 # Optional template for a known vendor (can be expanded in a JSON config file)
@@ -62,10 +104,46 @@ KNOWN_VENDOR_TEMPLATE = {
     "vendor_name": "Acme Corp",
     "regex_overrides": {
         "invoice_number": r"ACME-INV-(\d+)",
-        "date": r"Billing Date:\s*(\d{4}-\d{2}-\d{2})"
+        "date": r"BILLING DATE:\s*(\d{4}-\d{2}-\d{2})"
     }
 }
 
+def _as_literal(pattern: str) -> Optional[str]:
+    """
+    Returns the fixed string a pattern matches if it is just an (escaped) literal inside
+    a single capture group, e.g. r"(S\.K\.P\.S DIGITAL)". Returns None for real regexes.
+    """
+    if not (pattern.startswith("(") and pattern.endswith(")")):
+        return None
+    inner = pattern[1:-1]
+    # Any metacharacter left once escaped punctuation is removed means this is a real regex
+    if re.search(r"[.^$*+?{}\[\]|()\\]", re.sub(r"\\[^\w\s]", "", inner)):
+        return None
+    return re.sub(r"\\([^\w\s])", r"\1", inner)
+
+# Fields whose pattern is a plain string are matched with a substring check instead of the regex engine
+LITERAL_FIELDS: Dict[str, str] = {
+    field: literal for field, pattern in INVOICE_CONFIG.items()
+    if (literal := _as_literal(pattern)) is not None
+}
+
+def _compile_pattern(pattern: str) -> re.Pattern:
+    """
+    Compiles a config pattern as a bytes regex.
+    No IGNORECASE/MULTILINE: the text is upper-cased up front and no pattern uses ^ or $.
+    """
+    return re.compile(pattern.encode('ascii'))
+
+# Compile every other pattern once at import so parsing doesn't pay for re's cache lookup on each call
+INVOICE_CONFIG_COMPILED: Dict[str, re.Pattern] = {
+    field: _compile_pattern(pattern) for field, pattern in INVOICE_CONFIG.items()
+    if field not in LITERAL_FIELDS
+}
+KNOWN_VENDOR_COMPILED: Dict[str, re.Pattern] = {
+    field: _compile_pattern(pattern)
+    for field, pattern in KNOWN_VENDOR_TEMPLATE["regex_overrides"].items()
+}
+
 # Pydantic Models for structured data
 class LineItem(BaseModel):
     quantity: Optional[float] = 1.0  # Default to 1 if QTY is not extractable
@@ -86,161 +164,300 @@ class ParsedInvoice(BaseModel):
 
 # --- 2. IMAGE PREPROCESSING UTILITIES ---
 
-def preprocess_image(image_bytes: bytes) -> Image.Image:
+# Longest side (px) kept for OCR: about 210 DPI for an A4 page (300 DPI would be ~3500 px),
+# still ample for the printed invoice text this API targets
+MAX_IMAGE_DIMENSION = 2500
+
+def _is_pdf(image_bytes: bytes) -> bool:
+    """Checks the PDF magic bytes, so the format is known without a PIL header parse."""
+    return image_bytes[:4] == b'%PDF'
+
+def _preprocess_mock(image_bytes: bytes) -> bytes:
+    """
+    Mock preprocessing used when the OCR dependencies are missing. The mock OCR ignores
+    its input, so the bytes are passed through untouched (PIL may not be importable here).
+    """
+    return image_bytes
+
+def _preprocess_opencv(image_bytes: bytes) -> "np.ndarray":
     """
     Performs preprocessing steps (binarization, deskew) on the image bytes.
-    Returns a PIL Image object.
+    Returns a single-channel (grayscale) uint8 numpy array, C-contiguous.
     """
-    try:
-        if not HAS_OCR_DEPS or 'pdf' in Image.open(BytesIO(image_bytes)).format.lower():
-            # If dependencies are missing or it's a PDF, just open the image/PDF first page as PIL Image
-            return Image.open(BytesIO(image_bytes)).convert('RGB')
-    except Exception:
-        # Fallback for unexpected image format issues
-        pass
+    if _is_pdf(image_bytes):
+        # If it's a PDF, just open the first page with PIL, grayscale like the OpenCV path
+        try:
+            return np.asarray(Image.open(BytesIO(image_bytes)).convert('L'))
+        except OSError as e:
+            raise ValueError(f"Could not open PDF document: {e}")
 
     # Proceed with OpenCV preprocessing for better OCR on images
-    if not HAS_OCR_DEPS:
-        # Mock preprocessing: just open the image
-        return Image.open(BytesIO(image_bytes)).convert('RGB')
-
     # Convert bytes to numpy array
     nparr = np.frombuffer(image_bytes, np.uint8)
-    # Use IMREAD_COLOR to ensure 3 channels for color conversion later, even if decoding a grayscale image
-    img_cv = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    # Decode straight to a single 8-bit channel: colour inputs are converted by the decoder,
+    # grayscale scans (common for TIFF archives) are never inflated to 3 channels
+    gray = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
 
-    if img_cv is None:
-        # Try decoding as grayscale if color fails (some TIFF formats)
-        img_cv = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
-        if img_cv is None:
-              raise ValueError("Could not decode image bytes into OpenCV format.")
-        # Convert grayscale to 3-channel for consistency
-        img_cv = cv2.cvtColor(img_cv, cv2.COLOR_GRAY2BGR)
+    if gray is None:
+        raise ValueError("Could not decode image bytes into OpenCV format.")
 
+    # Downscale oversized scans (e.g. 4000x3000 phone photos) to MAX_IMAGE_DIMENSION on the long side.
+    # The extra pixels mostly cost OCR time, and every following pass gets cheaper
+    max_dim = max(gray.shape[:2])
+    if max_dim > MAX_IMAGE_DIMENSION:
+        scale = MAX_IMAGE_DIMENSION / max_dim
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
 
-    # Convert to grayscale for thresholding
-    gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY)
-
-    # Binarization (simple adaptive thresholding)
-    thresh = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-                                   cv2.THRESH_BINARY, 11, 2)
+    # Binarization (global Otsu, single histogram pass). Only used as a foreground mask for
+    # deskewing, so inverted: text pixels are non-zero, paper is zero
+    _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
 
     # Deskewing (simple approximation)
     try:
-        coords = np.column_stack(np.where(thresh > 0))
-        if coords.size > 0:
+        # Compact int32 (x, y) point list built in C, fed straight to minAreaRect
+        coords = cv2.findNonZero(thresh)
+        if coords is not None:
             angle = cv2.minAreaRect(coords)[-1]
-            
-            if angle < -45:
-                angle = -(90 + angle)
-            else:
-                angle = -angle
 
-            (h, w) = img_cv.shape[:2]
+            # Normalise to the smallest correcting rotation; OpenCV >= 4.5 reports (0, 90],
+            # older versions [-90, 0)
+            if angle > 45:
+                angle = angle - 90
+            elif angle < -45:
+                angle = angle + 90
+
+            (h, w) = gray.shape[:2]
             center = (w // 2, h // 2)
             M = cv2.getRotationMatrix2D(center, angle, 1.0)
-            rotated = cv2.warpAffine(img_cv, M, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+            rotated = cv2.warpAffine(gray, M, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
         else:
-            rotated = img_cv # No deskewing if no text found
+            rotated = gray # No deskewing if no text found
 
     except cv2.error:
         # Handle case where minAreaRect fails on highly sparse/corrupt images
-        rotated = img_cv
+        rotated = gray
+
+    # Tesseract works on grayscale internally, so the single-channel array is handed over as-is
+    return np.ascontiguousarray(rotated)
 
-    # Convert back to PIL Image (which Tesseract expects)
-    return Image.fromarray(cv2.cvtColor(rotated, cv2.COLOR_BGR2RGB))
+# The deployment's regime is fixed at import, so pick the implementation once instead of
+# re-checking the available dependencies on every request
+preprocess_image = _preprocess_opencv if HAS_OCR_DEPS else _preprocess_mock
 
 
 # --- 3. OCR EXTRACTION UTILITY ---
 
-def extract_text_tesseract(image: Image.Image) -> str:
+def _mock_extract(image) -> str:
     """
-    Performs OCR on the preprocessed image to extract raw text.
+    Returns placeholder text, used when the OCR dependencies are missing.
+    """
+    print("MOCK OCR: Returning placeholder text.")
+    return ("Acme Corp\n"
+            "123 Main St, Anytown, USA\n"
+            "Invoice No: ACME-INV-45678\n"
+            "Date: 01/01/2024\n"
+            "GSTIN: 22AAAAA0000A1Z5\n"
+            "ITEM QTY RATE TOTAL\n"
+            "1. Consulting Service 1 500.00 500.00\n"
+            "2. Software License 2 150.00 300.00\n"
+            "Subtotal: 800.00\n"
+            "TAX (10%): 80.00\n"
+            "GRAND TOTAL: 880.00")
+
+def _tesserocr_extract(image: "np.ndarray") -> str:
+    """
+    Performs OCR on the preprocessed (grayscale numpy) image in-process via tesserocr,
+    reusing the already-loaded model for this thread.
+    """
+    try:
+        # Raw 8-bit pixels go straight to libtesseract, no PIL round-trip
+        image = np.ascontiguousarray(image)
+        (h, w) = image.shape[:2]
+        api = _get_tess_api()
+        api.SetImageBytes(image.tobytes(), w, h, 1, w)
+        return api.GetUTF8Text()
+    except Exception as e:
+        raise RuntimeError(f"tesseract is not installed or it's not in your PATH. See README file for more information. Error: {e}")
+
+def _pytesseract_extract(image: "np.ndarray") -> str:
+    """
+    Performs OCR on the preprocessed (grayscale numpy) image with the Tesseract CLI.
     """
-    if not HAS_OCR_DEPS:
-        # Return mock data if dependencies are missing
-        print("MOCK OCR: Returning placeholder text.")
-        return ("Acme Corp\n"
-                "123 Main St, Anytown, USA\n"
-                "Invoice No: ACME-INV-45678\n"
-                "Date: 01/01/2024\n"
-                "GSTIN: 22AAAAA0000A1Z5\n"
-                "ITEM QTY RATE TOTAL\n"
-                "1. Consulting Service 1 500.00 500.00\n"
-                "2. Software License 2 150.00 300.00\n"
-                "Subtotal: 800.00\n"
-                "TAX (10%): 80.00\n"
-                "GRAND TOTAL: 880.00")
-    
     try:
-        # Use Tesseract to extract text
         # '-l eng' specifies language as English
         return pytesseract.image_to_string(image, lang='eng')
     except Exception as e:
         # Catch errors related to tesseract not being in PATH
         raise RuntimeError(f"tesseract is not installed or it's not in your PATH. See README file for more information. Error: {e}")
 
+# Bound once at import, like preprocess_image
+if HAS_TESSEROCR:
+    extract_text_tesseract = _tesserocr_extract
+elif HAS_OCR_DEPS:
+    extract_text_tesseract = _pytesseract_extract
+else:
+    extract_text_tesseract = _mock_extract
+
+
+def run_ocr_pipeline(image_bytes: bytes) -> str:
+    """
+    Preprocesses the raw upload bytes and runs OCR on the result.
+    Kept as a single call so it can run in a worker process without pickling the image.
+    """
+    return extract_text_tesseract(preprocess_image(image_bytes))
+
+
+# Tesseract can stall on very long image lists, so batches are capped
+MAX_BATCH_SIZE = 50
+
+class BatchPageMismatchError(Exception):
+    """Raised when a batch tesseract run returns fewer pages than images were sent."""
+
+def run_batch_ocr_pipeline(images: List[bytes]) -> List[str]:
+    """
+    Preprocesses a batch of uploads and OCRs them with a single tesseract invocation.
+    The preprocessed pages are written to a temp dir and listed in a text file, which
+    tesseract accepts as input; its output separates pages with form feeds.
+    Returns one raw text per input image, in order.
+    """
+    if HAS_TESSEROCR or not HAS_OCR_DEPS:
+        # In-process OCR already keeps the model loaded between images (and mock mode has no CLI)
+        return [run_ocr_pipeline(image_bytes) for image_bytes in images]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        page_paths = []
+        for i, image_bytes in enumerate(images):
+            page_path = os.path.join(tmp_dir, f"page_{i}.png")
+            cv2.imwrite(page_path, preprocess_image(image_bytes))
+            page_paths.append(page_path)
+
+        list_path = os.path.join(tmp_dir, "list.txt")
+        with open(list_path, "w") as list_file:
+            list_file.write("\n".join(page_paths) + "\n")
+
+        try:
+            batch_text = pytesseract.image_to_string(list_path, lang='eng')
+        except Exception as e:
+            raise RuntimeError(f"tesseract is not installed or it's not in your PATH. See README file for more information. Error: {e}")
+
+    pages = batch_text.split('\x0c')
+    if len(pages) < len(images):
+        raise BatchPageMismatchError(f"Tesseract returned {len(pages)} pages for a batch of {len(images)} images.")
+    return pages[:len(images)]
+
+
+def warm_up_ocr_worker() -> None:
+    """
+    Runs a tiny blank image through preprocessing and OCR so the Tesseract model and
+    OpenCV's buffers are loaded before the first real upload reaches this process.
+    """
+    if not HAS_OCR_DEPS:
+        return
+    try:
+        _, png = cv2.imencode('.png', np.full((64, 64), 255, np.uint8))
+        extract_text_tesseract(preprocess_image(png.tobytes()))
+    except Exception as e:
+        # Best effort: real requests will still report any Tesseract configuration error
+        print(f"OCR warm-up failed: {e}")
+
+
+# --- OCR RESULT CACHE ---
+# Identical uploads (retries, repeated test files) reuse the OCR text instead of re-running
+# preprocessing + Tesseract. Keyed by a content hash; xxhash's XXH3 is used when installed.
+try:
+    import xxhash
+
+    def file_digest(data: bytes) -> str:
+        """Returns a content hash of the upload bytes."""
+        return xxhash.xxh3_128_hexdigest(data)
+except ImportError:
+    def file_digest(data: bytes) -> str:
+        """Returns a content hash of the upload bytes."""
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+OCR_CACHE_SIZE = 256
+OCR_CACHE: "OrderedDict[str, str]" = OrderedDict()
+
+def ocr_cache_get(digest: str) -> Optional[str]:
+    """Returns the cached OCR text for a file digest, marking it as recently used."""
+    raw_text = OCR_CACHE.get(digest)
+    if raw_text is not None:
+        OCR_CACHE.move_to_end(digest)
+    return raw_text
+
+def ocr_cache_put(digest: str, raw_text: str) -> None:
+    """Caches the OCR text for a file digest, evicting the least recently used entry when full."""
+    OCR_CACHE[digest] = raw_text
+    OCR_CACHE.move_to_end(digest)
+    if len(OCR_CACHE) > OCR_CACHE_SIZE:
+        OCR_CACHE.popitem(last=False)
+
 
 # --- 4. PARSING LOGIC ---
 
+# Currency symbols, parentheses (often used for negatives), and thousand separators
+_CURRENCY_TRANS = str.maketrans('', '', '$€£(),')
+
 def parse_float(value: str) -> Optional[float]:
     """Helper to safely convert string to float."""
     if value:
         try:
-            # Remove currency symbols, parentheses (often used for negatives), and thousand separators
-            clean_value = re.sub(r'[$,€£()]', '', value).replace(',', '').strip()
+            # Strip the currency characters in a single pass
+            clean_value = value.translate(_CURRENCY_TRANS).strip()
             return float(clean_value)
         except ValueError:
             return None
     return None
 
-def parse_line_items(raw_text: str, pattern: str) -> List[LineItem]:
+def _to_search_text(raw_text: str) -> bytes:
+    """
+    Returns the upper-cased ASCII bytes the config patterns are matched against.
+    Each non-ASCII character becomes a single '?', so match offsets line up with raw_text.
+    """
+    return raw_text.encode('ascii', 'replace').upper()
+
+def _group_text(raw_text: str, match, group: int) -> Optional[str]:
+    """Returns a match group as it appears in the original (not upper-cased) text."""
+    start, end = match.span(group)
+    if start < 0:
+        # Group did not participate in the match
+        return None
+    return raw_text[start:end]
+
+def parse_line_items(raw_text: str, pattern: re.Pattern, search_text: Optional[bytes] = None) -> List[LineItem]:
     """
-    Attempts to extract line items using the specific regex pattern.
+    Attempts to extract line items using the specific (pre-compiled) regex pattern.
+    `search_text` is the _to_search_text form of raw_text, if the caller already has it.
     """
-    lines = raw_text.split('\n')
     line_items: List[LineItem] = []
-    
-    # Heuristic: Look for the line item section explicitly
-    start_index = -1
-    for i, line in enumerate(lines):
-        if re.search(r'ITEM NAME \d', line, re.IGNORECASE):
-            start_index = i
-            break
-            
-    if start_index != -1:
-        # Search from the first line item onwards
-        for line in lines[start_index:]:
-            # Check for lines that don't look like totals/subtotals
-            if not re.search(r'(SUBTOTAL|TAX|TOTAL|BALANCE|GST|PAYABLE)', line, re.IGNORECASE):
-                # The regex pattern specifically targets the `ITEM NAME N Rs. X Rs. Y` format
-                match = re.search(pattern, line, re.IGNORECASE)
-                if match:
-                    try:
-                        # Since QTY is missing, we use a simple description based on the line
-                        description = f"ITEM NAME {line.split()[2]}" # e.g., 'ITEM NAME 2'
-                        
-                        # Group 1 = Rate/Unit Price; Group 2 = Line Total
-                        unit_price = parse_float(match.group(1).strip())
-                        line_total = parse_float(match.group(2).strip())
-                        
-                        # We assume quantity is 1.0 or can be derived from Total/Rate (if Rate != 0)
-                        quantity = 1.0
-                        if unit_price and line_total and unit_price > 0:
-                            # Try to calculate quantity if data is available
-                            quantity = round(line_total / unit_price)
-                        
-                        if description:
-                            line_items.append(LineItem(
-                                quantity=float(quantity), # Ensure it's a float
-                                description=description,
-                                unit_price=unit_price,
-                                line_total=line_total
-                            ))
-                    except IndexError:
-                        continue
-                    except Exception as e:
-                        print(f"Error parsing line item: {e}")
+    if search_text is None:
+        search_text = _to_search_text(raw_text)
+
+    # Single scan over the whole text: the pattern is anchored on `ITEM NAME N`, so it only
+    # ever matches item rows and never the SUBTOTAL/TAX/TOTAL lines that follow them.
+    for match in pattern.finditer(search_text):
+        try:
+            # Since QTY is missing, we use a simple description based on the item number
+            description = f"ITEM NAME {_group_text(raw_text, match, 1)}" # e.g., 'ITEM NAME 2'
+
+            # Group 2 = Rate/Unit Price; Group 3 = Line Total
+            unit_price = parse_float(_group_text(raw_text, match, 2).strip())
+            line_total = parse_float(_group_text(raw_text, match, 3).strip())
+
+            # We assume quantity is 1.0 or can be derived from Total/Rate (if Rate != 0)
+            quantity = 1.0
+            if unit_price and line_total and unit_price > 0:
+                # Try to calculate quantity if data is available
+                quantity = round(line_total / unit_price)
+
+            line_items.append(LineItem(
+                quantity=float(quantity), # Ensure it's a float
+                description=description,
+                unit_price=unit_price,
+                line_total=line_total
+            ))
+        except Exception as e:
+            print(f"Error parsing line item: {e}")
 
     return line_items
 
@@ -263,18 +480,32 @@ def parse_invoice_data(raw_text: str) -> ParsedInvoice:
         is_known_vendor = True
         vendor_name_guess = KNOWN_VENDOR_TEMPLATE["vendor_name"]
         
-    patterns = INVOICE_CONFIG.copy()
+    patterns = INVOICE_CONFIG_COMPILED.copy()
     if is_known_vendor:
-        patterns.update(KNOWN_VENDOR_TEMPLATE["regex_overrides"])
+        patterns.update(KNOWN_VENDOR_COMPILED)
+
+    # Upper-cased ASCII form of the text, shared by every pattern below
+    search_text = _to_search_text(raw_text)
+
+    # 2a. Extract Fixed-String Fields (case-insensitive substring check)
+    for field, literal in LITERAL_FIELDS.items():
+        if field in patterns:
+            # A vendor template override takes precedence over the generic literal
+            continue
+        if literal.upper().encode('ascii', 'replace') in search_text:
+            parsed_data[field] = literal
+        else:
+            print(f"LOG: Field '{field}' could not be parsed.")
         
-    # 2. Extract General Fields
+    # 2b. Extract General Fields
     for field, pattern in patterns.items():
         if field not in ["line_item_pattern"]:
             # Use search for the first match anywhere in the text
-            match = re.search(pattern, raw_text, re.IGNORECASE | re.MULTILINE)
+            match = pattern.search(search_text)
             if match:
                 try:
-                    value = match.group(1).strip()
+                    # Take the value from the original text so its case is preserved
+                    value = _group_text(raw_text, match, 1).strip()
                     if field in ["total_amount", "tax_amount"]:
                         parsed_data[field] = parse_float(value)
                     elif field == "vendor_name":
@@ -291,7 +522,7 @@ def parse_invoice_data(raw_text: str) -> ParsedInvoice:
                 print(f"LOG: Field '{field}' could not be parsed.")
 
     # 3. Extract Line Items using the modified logic
-    line_items = parse_line_items(raw_text, INVOICE_CONFIG["line_item_pattern"])
+    line_items = parse_line_items(raw_text, INVOICE_CONFIG_COMPILED["line_item_pattern"], search_text)
 
     # 4. Construct the final model
     invoice = ParsedInvoice(
@@ -305,12 +536,20 @@ def parse_invoice_data(raw_text: str) -> ParsedInvoice:
 
 # --- 5. CSV UTILITY ---
 
-def generate_csv_string(invoice: ParsedInvoice) -> str:
+def iter_csv_rows(invoice: ParsedInvoice) -> Iterator[bytes]:
     """
-    Converts the ParsedInvoice model into a CSV string.
+    Converts the ParsedInvoice model into CSV, yielding encoded chunks
+    (the header block, then one chunk per line item) so it can be streamed.
     """
     output = StringIO()
     writer = csv.writer(output)
+
+    def flush() -> bytes:
+        # Hand back what has been written so far and reuse the buffer
+        chunk = output.getvalue()
+        output.seek(0)
+        output.truncate()
+        return chunk.encode('utf-8')
     
     # 1. Write Header Data (Key-Value Pairs)
     header_fields = [
@@ -332,6 +571,7 @@ def generate_csv_string(invoice: ParsedInvoice) -> str:
     # 2. Write Line Item Header
     writer.writerow(["--- LINE ITEMS ---"])
     writer.writerow(["Description", "Quantity", "Unit Price", "Line Total"])
+    yield flush()
     
     # 3. Write Line Item Rows
     for item in invoice.line_items:
@@ -341,15 +581,39 @@ def generate_csv_string(invoice: ParsedInvoice) -> str:
             item.unit_price,
             item.line_total
         ])
-        
-    return output.getvalue()
+        yield flush()
 
 
 # --- 6. FASTAPI APPLICATION SETUP ---
 
+# Number of API worker processes (the variable uvicorn and gunicorn both read).
+# Defaults to 1 like the uvicorn CLI; more workers need shared storage (see MOCK_DATABASE)
+API_WORKERS = int(os.environ.get("WEB_CONCURRENCY", 1))
+
+# Number of worker processes for the CPU-bound OpenCV + Tesseract stage (per API worker).
+# By default the cores are split between the API workers so the machine isn't oversubscribed
+OCR_POOL_WORKERS = int(os.environ.get("OCR_POOL_WORKERS", max(1, (os.cpu_count() or 1) // API_WORKERS)))
+
+def create_ocr_pool() -> ProcessPoolExecutor:
+    """Creates the OCR process pool; each worker process warms up its OCR stack on start."""
+    return ProcessPoolExecutor(max_workers=OCR_POOL_WORKERS, initializer=warm_up_ocr_worker)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Creates the process pool used to keep OCR off the event loop thread and starts every
+    worker up front, each warming up its OCR stack, so the first uploads don't pay for it.
+    """
+    app.state.pool = create_ocr_pool()
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(app.state.pool, os.getpid) for _ in range(OCR_POOL_WORKERS)))
+    yield
+    app.state.pool.shutdown()
+
 app = FastAPI(
     title="OCR Invoice Data Extractor",
-    description="Backend for extracting structured data from invoice images/PDFs."
+    description="Backend for extracting structured data from invoice images/PDFs.",
+    lifespan=lifespan
 )
 
 # FIX: CORS configuration updated to explicitly allow the Hugging Face Space URL.
@@ -368,6 +632,48 @@ app.add_middleware(
 
 # --- 7. REST ENDPOINTS ---
 
+# Upload MIME types accepted by the extraction endpoints
+ALLOWED_CONTENT_TYPES = ["image/jpeg", "image/png", "application/pdf", "image/tiff"]
+
+def processing_error(e: Exception) -> HTTPException:
+    """
+    Maps an error raised while reading, OCRing or parsing an upload to the HTTP error
+    returned by the extraction endpoints.
+    """
+    if isinstance(e, BatchPageMismatchError):
+        # Tesseract ran, but its output could not be split back into one text per file
+        print(f"Batch OCR page mismatch: {e}")
+        return HTTPException(status_code=500, detail=f"Could not match the OCR output to the uploaded files. Error: {e}")
+    if isinstance(e, RuntimeError):
+        # The specific error raised by extract_text_tesseract for Tesseract PATH issue
+        print(f"Tesseract Configuration Error: {e}")
+        # Returned as 500 to show the user the detailed error in the frontend
+        return HTTPException(status_code=500, detail=str(e))
+    if isinstance(e, ValueError):
+        print(f"Error during file decoding/preprocessing: {e}")
+        return HTTPException(status_code=422, detail=f"File processing error: {e}")
+    # Any other unexpected error
+    print(f"Internal server error: {e}")
+    return HTTPException(status_code=500, detail=f"An unexpected error occurred during processing. Error: {e}")
+
+async def run_in_ocr_pool(func, *args):
+    """
+    Runs func(*args) in the OCR process pool.
+    If a pool process died (OOM kill, crash inside libtesseract/OpenCV) the pool is broken for
+    good, so it is replaced with a fresh one and the current request fails with a 500.
+    """
+    pool = app.state.pool
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(pool, func, *args)
+    except BrokenProcessPool as e:
+        print(f"OCR worker process died, restarting the pool: {e}")
+        # Concurrent requests fail on the same pool; only the first one replaces it
+        if app.state.pool is pool:
+            pool.shutdown(wait=False)
+            app.state.pool = create_ocr_pool()
+        raise HTTPException(status_code=500, detail="The OCR worker process crashed while processing the document. Please try again.")
+
 @app.get("/", tags=["Health"])
 async def root():
     """Simple health check."""
@@ -379,17 +685,20 @@ async def upload_invoice(file: UploadFile = File(...)):
     Uploads an invoice (image or PDF), runs OCR, and returns the parsed structured data.
     """
     # Check for acceptable MIME types
-    if file.content_type not in ["image/jpeg", "image/png", "application/pdf", "image/tiff"]:
+    if file.content_type not in ALLOWED_CONTENT_TYPES:
         raise HTTPException(status_code=400, detail="Invalid file type. Please upload JPG, PNG, TIFF, or PDF.")
         
     try:
         file_bytes = await file.read()
         
-        # 1. Preprocessing (handles PDF/Image/Mock)
-        preprocessed_img = preprocess_image(file_bytes)
-        
-        # 2. OCR Extraction - Will raise RuntimeError if Tesseract is not found/configured
-        raw_text = extract_text_tesseract(preprocessed_img)
+        # 1. Preprocessing (handles PDF/Image/Mock) + 2. OCR Extraction, run in the process pool
+        # so the event loop keeps serving other requests.
+        # Will raise RuntimeError if Tesseract is not found/configured
+        digest = file_digest(file_bytes)
+        raw_text = ocr_cache_get(digest)
+        if raw_text is None:
+            raw_text = await run_in_ocr_pool(run_ocr_pipeline, file_bytes)
+            ocr_cache_put(digest, raw_text)
         
         if not raw_text.strip():
             # Tesseract ran but found no legible text
@@ -399,22 +708,62 @@ async def upload_invoice(file: UploadFile = File(...)):
         parsed_invoice = parse_invoice_data(raw_text)
         
         # 4. Storage (Mock Database)
-        MOCK_DATABASE[parsed_invoice.invoice_id] = parsed_invoice.model_dump()
+        MOCK_DATABASE[parsed_invoice.invoice_id] = parsed_invoice
         
         return parsed_invoice
         
-    except RuntimeError as e:
-        # Catch the specific error raised by extract_text_tesseract for Tesseract PATH issue
-        print(f"Tesseract Configuration Error: {e}")
-        # Re-raise as 500 to show the user the detailed error in the frontend
-        raise HTTPException(status_code=500, detail=str(e))
-    except ValueError as e:
-        print(f"Error during file decoding/preprocessing: {e}")
-        raise HTTPException(status_code=422, detail=f"File processing error: {e}")
+    except HTTPException:
+        raise
     except Exception as e:
-        # Catch any other unexpected error
-        print(f"Internal server error: {e}")
-        raise HTTPException(status_code=500, detail=f"An unexpected error occurred during processing. Error: {e}")
+        raise processing_error(e)
+
+
+@app.post("/upload-invoices-batch", response_model=List[ParsedInvoice], tags=["Extraction"])
+async def upload_invoices_batch(files: List[UploadFile] = File(...)):
+    """
+    Uploads several invoices at once and OCRs them in a single Tesseract run,
+    returning the parsed structured data for each file in upload order.
+    """
+    if len(files) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"Too many files. Please upload at most {MAX_BATCH_SIZE} invoices per batch.")
+
+    # Check for acceptable MIME types
+    for file in files:
+        if file.content_type not in ALLOWED_CONTENT_TYPES:
+            raise HTTPException(status_code=400, detail=f"Invalid file type for '{file.filename}'. Please upload JPG, PNG, TIFF, or PDF.")
+
+    try:
+        images = [await file.read() for file in files]
+
+        # 1. Preprocessing + 2. OCR Extraction for the files not already cached, run in the process pool
+        digests = [file_digest(image_bytes) for image_bytes in images]
+        raw_texts = [ocr_cache_get(digest) for digest in digests]
+        missing = [i for i, raw_text in enumerate(raw_texts) if raw_text is None]
+        if missing:
+            batch_texts = await run_in_ocr_pool(run_batch_ocr_pipeline, [images[i] for i in missing])
+            for i, raw_text in zip(missing, batch_texts):
+                raw_texts[i] = raw_text
+                ocr_cache_put(digests[i], raw_text)
+
+        parsed_invoices: List[ParsedInvoice] = []
+        for file, raw_text in zip(files, raw_texts):
+            if not raw_text.strip():
+                # Tesseract ran but found no legible text
+                raise HTTPException(status_code=500, detail=f"OCR failed to extract any legible text from '{file.filename}'.")
+
+            # 3. Parsing
+            parsed_invoices.append(parse_invoice_data(raw_text))
+
+        # 4. Storage (Mock Database)
+        for parsed_invoice in parsed_invoices:
+            MOCK_DATABASE[parsed_invoice.invoice_id] = parsed_invoice
+
+        return parsed_invoices
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise processing_error(e)
 
 
 @app.get("/download-csv/{invoice_id}", tags=["Extraction"])
@@ -422,27 +771,22 @@ async def download_csv(invoice_id: str):
     """
     Downloads the structured data for a specific invoice ID as a CSV file.
     """
-    invoice_data = MOCK_DATABASE.get(invoice_id)
+    invoice_model = MOCK_DATABASE.get(invoice_id)
     
-    if not invoice_data:
+    if not invoice_model:
         raise HTTPException(status_code=404, detail=f"Invoice with ID {invoice_id} not found.")
 
-    try:
-        invoice_model = ParsedInvoice(**invoice_data)
-        csv_content = generate_csv_string(invoice_model)
-        
-        filename = f"invoice_data_{invoice_id}.csv"
-        
-        return Response(
-            content=csv_content,
-            media_type="text/csv",
-            headers={
-                "Content-Disposition": f"attachment; filename={filename}",
-            }
-        )
-    except Exception as e:
-        print(f"Error generating CSV: {e}")
-        raise HTTPException(status_code=500, detail="Could not generate CSV file.")
+    filename = f"invoice_data_{invoice_id}.csv"
+    
+    # Rows are encoded and sent as they are written instead of building the whole file first.
+    # iter_csv_rows only runs after this handler returns, so it can't be wrapped in an HTTP error here
+    return StreamingResponse(
+        iter_csv_rows(invoice_model),
+        media_type="text/csv",
+        headers={
+            "Content-Disposition": f"attachment; filename={filename}",
+        }
+    )
 
 
 # --- 8. RUN APPLICATION ---
@@ -454,4 +798,9 @@ if __name__ == "__main__":
           print("  and ensure Tesseract is installed on your system.   ")
           print("=======================================================\n")
           
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # A single API worker unless WEB_CONCURRENCY is set explicitly: MOCK_DATABASE is per process,
+    # so upload + download only work reliably with one. OCR still uses every core via the pool.
+    # Exported so every worker process sizes its OCR pool from the same value.
+    # loop/http "auto" pick uvloop and httptools (installed with uvicorn[standard]).
+    workers = int(os.environ.setdefault("WEB_CONCURRENCY", "1"))
+    uvicorn.run("invoice_ocr_api:app", host="0.0.0.0", port=8000, workers=workers, loop="auto", http="auto")